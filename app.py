@@ -1,14 +1,23 @@
 import argparse
+import asyncio
+import collections
+import functools
+import hashlib
+import itertools
 import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 from dotenv import load_dotenv
 from langchain.chains import GraphCypherQAChain
 from langchain.prompts import PromptTemplate
-from langchain_community.document_loaders.generic import GenericLoader
+from langchain_community.document_loaders.blob_loaders import Blob
 from langchain_community.document_loaders.parsers import LanguageParser
 from langchain_community.graphs import Neo4jGraph
 from langchain_openai import ChatOpenAI
 from langchain_text_splitters import Language, RecursiveCharacterTextSplitter
+from neo4j import AsyncGraphDatabase
 
 # Set up OpenAI credentials
 load_dotenv()
@@ -18,102 +27,344 @@ os.environ["NEO4J_URI"] = "bolt://localhost:7687"
 os.environ["NEO4J_USERNAME"] = "neo4j"
 os.environ["NEO4J_PASSWORD"] = "password"
 
-# Initialize Neo4j graph
+# Initialize Neo4j graph once; its bolt connection pool is shared by
+# ingestion and the QA chain
 graph = Neo4jGraph()
 
+# Schema string captured after ingestion so the QA chain doesn't rerun
+# the metadata scan on every setup
+_schema_cache = None
+
+# Initialize the language model once so its HTTP connection pool is
+# reused across chain constructions
+llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+
+# How many chunks to send to Neo4j per UNWIND query, and how many of
+# those batches to keep in flight concurrently
+BATCH_SIZE = 1000
+WRITE_CONCURRENCY = 10
+
+# File types we load, directories we never descend into, and file name
+# patterns we skip (dot files, virtual environments)
+SUFFIXES = frozenset({".py", ".js", ".go", ".md", ".html"})
+EXCLUDE_DIRS = frozenset({".git", "node_modules", "venv", ".venv", "__pycache__"})
+EXCLUDE_PATTERNS = [r"^\..*"]
+# One compiled alternation: a single regex pass per file name instead of
+# one match per pattern
+EXCLUDE_RE = re.compile("|".join(f"(?:{pattern})" for pattern in EXCLUDE_PATTERNS))
+
+def find_source_files(directory_path):
+    """Return the paths of all loadable source files under directory_path."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory_path):
+        # Prune excluded directories in place so os.walk never descends
+        # into them (node_modules, .git, ... can dwarf the real tree)
+        dirnames[:] = [d for d in dirnames
+                       if d not in EXCLUDE_DIRS and not d.startswith('.')]
+        for filename in filenames:
+            if os.path.splitext(filename)[1] not in SUFFIXES:
+                continue
+            if EXCLUDE_RE.search(filename):
+                continue
+            paths.append(os.path.join(dirpath, filename))
+    return paths
+
+def parse_file(file_path):
+    """Parse a single source file into documents. Runs in a worker process."""
+    return LanguageParser().parse(Blob.from_path(file_path))
+
+async def write_chunk_batches(rows):
+    """Write chunk rows to Neo4j, one explicit transaction per batch.
+
+    Grouping each UNWIND batch in its own transaction amortizes the
+    per-commit log flush, and dispatching up to WRITE_CONCURRENCY batches
+    concurrently overlaps their commit latency. The semaphore is acquired
+    before the next batch is built, so memory stays bounded to the
+    batches in flight. Batches run as managed transactions: concurrent
+    MERGEs over overlapping hashes can deadlock, and execute_write
+    retries those transient failures instead of aborting the ingestion.
+    """
+    query = """
+    UNWIND $rows AS row
+    MERGE (f:CodeChunk {hash: row.hash})
+    ON CREATE SET f.content = row.content, f.language = row.language,
+                  f.count = 1, f.names = [row.name]
+    ON MATCH SET f.count = f.count + 1,
+                 f.names = CASE WHEN row.name IN f.names
+                                THEN f.names ELSE f.names + row.name END
+    """
+    sem = asyncio.Semaphore(WRITE_CONCURRENCY)
+
+    driver = AsyncGraphDatabase.driver(
+        os.environ["NEO4J_URI"],
+        auth=(os.environ["NEO4J_USERNAME"], os.environ["NEO4J_PASSWORD"])
+    )
+
+    async def merge_rows(tx, batch):
+        await tx.run(query, rows=batch)
+
+    async def run_batch(batch):
+        try:
+            async with driver.session() as session:
+                await session.execute_write(merge_rows, batch)
+        finally:
+            sem.release()
+
+    total = 0
+    try:
+        tasks = []
+        for batch in batched(rows, BATCH_SIZE):
+            await sem.acquire()
+            tasks.append(asyncio.create_task(run_batch(batch)))
+            total += len(batch)
+        if tasks:
+            await asyncio.gather(*tasks)
+    finally:
+        await driver.close()
+    return total
+
+@functools.lru_cache(maxsize=None)
+def get_splitter(lang=None):
+    """Return the text splitter for a language, building each one only once."""
+    if lang is None:
+        # No language-specific separators (e.g. plain text)
+        return RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
+    return RecursiveCharacterTextSplitter.from_language(
+        language=lang,
+        chunk_size=1000,
+        chunk_overlap=0
+    )
+
+def batched(iterable, size):
+    """Yield lists of up to `size` items from `iterable`."""
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+def rebuild_same_language_edges(batch_size=1000):
+    """Rebuild per-language edges in memory-bounded batches.
+
+    The pipeline relies on the indexed language property instead of
+    relationships, so this is not called during ingestion. If a
+    downstream traversal genuinely needs SAME_LANGUAGE edges, this
+    streams the MERGE through apoc.periodic.iterate so the per-language
+    cross-product never sits in a single transaction; id(a) < id(b)
+    halves the edge count for an undirected reading. Requires the APOC
+    plugin.
+    """
+    graph.query("""
+    CALL apoc.periodic.iterate(
+      "MATCH (a:CodeChunk), (b:CodeChunk)
+       WHERE id(a) < id(b) AND a.language = b.language
+       RETURN a, b",
+      "MERGE (a)-[:SAME_LANGUAGE]->(b)",
+      {batchSize: $batch_size, parallel: false}
+    )
+    """, {"batch_size": batch_size})
+
+def ensure_graph_schema():
+    """Create the constraints and indexes ingestion relies on.
+
+    The uniqueness constraints back the MERGE keys (CodeChunk.hash,
+    IngestState.path) with an index, so MERGE stays an index lookup
+    instead of degrading to a label scan per inserted row. Must run
+    before the first batch write.
+    """
+    graph.query("""
+    CREATE CONSTRAINT code_chunk_hash IF NOT EXISTS
+    FOR (c:CodeChunk) REQUIRE c.hash IS UNIQUE
+    """)
+    graph.query("""
+    CREATE INDEX code_chunk_language IF NOT EXISTS
+    FOR (c:CodeChunk) ON (c.language)
+    """)
+    graph.query("""
+    CREATE CONSTRAINT ingest_state_path IF NOT EXISTS
+    FOR (s:IngestState) REQUIRE s.path IS UNIQUE
+    """)
+
 # %%
-def load_source_code_to_graph(directory_path):
+async def load_source_code_to_graph(directory_path):
     try:
-        # Load source code
-        loader = GenericLoader.from_filesystem(
-            directory_path,
-            glob="**/*",
-            suffixes=[".py", ".js", ".go", ".md", ".html"],
-            exclude=[r"^\..*"],  # Exclude .dot files and virtual environments
-            parser=LanguageParser()
+        ensure_graph_schema()
+
+        # Migration cleanup: drop SAME_LANGUAGE edges written by older
+        # versions. They bloat refresh_schema() and every {schema} prompt
+        # the LLM sees, costing tokens on each question. Legacy graphs
+        # hold O(N^2) of these edges, so delete in batched transactions
+        # rather than one transaction holding the whole edge set.
+        graph.query("""
+        MATCH ()-[r:SAME_LANGUAGE]->()
+        CALL { WITH r DELETE r } IN TRANSACTIONS OF 10000 ROWS
+        """)
+
+        # Load source code, skipping files whose mtime is unchanged since
+        # the last run, then parsing in parallel (parsing is CPU-bound)
+        file_paths = find_source_files(directory_path)
+        known = {
+            record['path']: record['mtime']
+            for record in graph.query(
+                "MATCH (s:IngestState) RETURN s.path AS path, s.mtime AS mtime"
+            )
+        }
+        mtimes = {path: os.stat(path).st_mtime_ns for path in file_paths}
+        changed = [path for path in file_paths if known.get(path) != mtimes[path]]
+        removed = [path for path in known if path not in mtimes]
+        print(f"Found {len(file_paths)} source files, "
+              f"{len(changed)} new or modified, {len(removed)} removed")
+        if not changed and not removed:
+            return
+
+        # Retire the previous version of every changed or removed file
+        # before new chunks are merged: walk the hashes its IngestState
+        # recorded, back out the file's name and count contribution, and
+        # delete chunks no other file still references. Only the
+        # occurrence count decides deletion: names is deduped by
+        # basename, so it can empty out while same-named files elsewhere
+        # in the tree still reference the chunk.
+        stale = [
+            {"path": path, "name": os.path.basename(path)}
+            for path in changed if path in known
+        ] + [
+            {"path": path, "name": os.path.basename(path)}
+            for path in removed
+        ]
+        for batch in batched(stale, BATCH_SIZE):
+            graph.query("""
+            UNWIND $rows AS row
+            MATCH (s:IngestState {path: row.path})
+            WHERE s.hashes IS NOT NULL
+            UNWIND s.hashes AS h
+            MATCH (c:CodeChunk {hash: h})
+            SET c.count = CASE WHEN c.count > 1 THEN c.count - 1 ELSE 0 END,
+                c.names = [n IN c.names WHERE n <> row.name]
+            WITH DISTINCT c
+            WHERE c.count <= 0
+            DETACH DELETE c
+            """, {"rows": batch})
+        if removed:
+            for batch in batched([{"path": path} for path in removed], BATCH_SIZE):
+                graph.query("""
+                UNWIND $rows AS row
+                MATCH (s:IngestState {path: row.path})
+                DELETE s
+                """, {"rows": batch})
+
+        max_workers = int(
+            os.environ.get("LOAD_NUM_WORKERS")
+            or max((os.cpu_count() or 2) - 1, 1)
         )
-        documents = loader.load()
-        
-        # Explicitly set document names
-        for doc in documents:
-            if 'source' in doc.metadata:
-                doc.metadata['name'] = os.path.basename(doc.metadata['source'])
-            else:
-                doc.metadata['name'] = 'Unknown'
-        
-        print(f"Loaded documents: {[doc.metadata.get('name', 'Unknown') for doc in documents]}")
-                                                                                                                                                                       
-        # Split documents if they're too large                                                                                                                        
-        languages = [                                                                                                                                                 
-            Language.PYTHON,                                                                                                                                          
-            Language.JS,                                                                                                                                              
-            Language.GO,                                                                                                                                              
-            Language.HTML,                                                                                                                                            
-            Language.MARKDOWN                                                                                                                                         
-        ]                                                                                                                                                             
-                                                                                                                                                                      
-        for lang in languages:                                                                                                                                        
-            text_splitter = RecursiveCharacterTextSplitter.from_language(                                                                                             
-                language=lang,                                                                                                                                        
-                chunk_size=1000,                                                                                                                                      
-                chunk_overlap=0                                                                                                                                       
-            )                                                                                                                                                         
-            split_docs = text_splitter.split_documents(documents)                                                                                                     
-            print(f"Split documents for {lang}: {len(split_docs)} chunks")                                                                                            
-                                                                                                                                                                      
-            # Populate Neo4j graph                                                                                                                                    
-            for doc in split_docs:                                                                                                                                    
-                query = """                                                                                                                                           
-                MERGE (f:CodeChunk {name: $name})                                                                                                                     
-                SET f.content = $content, f.language = $language                                                                                                      
-                """                                                                                                                                                   
-                graph.query(query, {                                                                                                                                  
-                    "name": doc.metadata.get('name', 'Unknown'),                                                                                                      
-                    "content": doc.page_content,                                                                                                                      
-                    "language": doc.metadata.get('language', 'Unknown')                                                                                               
-                })
-                                                                                                                                                                       
-        # Create relationships between code chunks                                                                                                                    
-        graph.query("""                                                                                                                                               
-        MATCH (a:CodeChunk), (b:CodeChunk)                                                                                                                            
-        WHERE a <> b AND a.language = b.language                                                                                                                      
-        MERGE (a)-[:SAME_LANGUAGE]->(b)                                                                                                                               
-        """)                                                                                                                                                          
+
+        # Remember which chunk hashes each file produced so the next run
+        # can retire them if the file changes again
+        hashes_by_path = collections.defaultdict(list)
+
+        # Stream documents through splitting into the batch writer so
+        # peak memory stays bounded by one slice of parsed files plus the
+        # write batches in flight, not the whole repo
+        def iter_documents():
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                # Submit one slice of paths at a time: a single map()
+                # over everything would let the workers race ahead of
+                # the throttled splitter/writer downstream and buffer
+                # parses for the whole repository
+                for path_slice in batched(changed, max_workers * 8):
+                    parsed = pool.map(parse_file, path_slice, chunksize=1)
+                    for path, docs in zip(path_slice, parsed):
+                        for doc in docs:
+                            # Explicitly set document names
+                            doc.metadata['name'] = os.path.basename(path)
+                            yield path, doc
+
+        def iter_rows():
+            for path, doc in iter_documents():
+                lang = doc.metadata.get('language', 'Unknown')
+                try:
+                    text_splitter = get_splitter(Language(lang))
+                except ValueError:
+                    text_splitter = get_splitter()
+                # split_text avoids allocating a Document per chunk just
+                # to carry metadata the row already has
+                for content in text_splitter.split_text(doc.page_content):
+                    # Deduplicate identical chunks (license headers,
+                    # boilerplate) on their content hash
+                    chunk_hash = hashlib.blake2b(
+                        content.encode(), digest_size=16
+                    ).hexdigest()
+                    hashes_by_path[path].append(chunk_hash)
+                    yield {
+                        "hash": chunk_hash,
+                        "name": doc.metadata.get('name', 'Unknown'),
+                        "content": content,
+                        "language": lang
+                    }
+
+        # Populate Neo4j graph in batches (one round-trip and one
+        # transaction per batch instead of one per chunk)
+        total = await write_chunk_batches(iter_rows())
+        print(f"Ingested {total} chunks")
+
+        # Record the mtimes we compared against (so the next run skips
+        # everything that hasn't changed since) and the chunk hashes each
+        # file produced (so its next change can retire them)
+        state_rows = [
+            {
+                "path": path,
+                "mtime": mtimes[path],
+                "hashes": hashes_by_path.get(path, [])
+            }
+            for path in changed
+        ]
+        for batch in batched(state_rows, BATCH_SIZE):
+            graph.query("""
+            UNWIND $rows AS row
+            MERGE (s:IngestState {path: row.path})
+            SET s.mtime = row.mtime, s.hashes = row.hashes
+            """, {"rows": batch})
                                                                                                                                                                        
-        # Refresh graph schema                                                                                                                                        
-        graph.refresh_schema()                                                                                                                                        
-        print("Graph schema updated:", graph.schema)                                                                                                                  
+        # Refresh graph schema once, now that ingestion changed it
+        global _schema_cache
+        graph.refresh_schema()
+        _schema_cache = graph.schema
+        print("Graph schema updated:", graph.schema)
     except Exception as e:                                                                                                                                            
         print(f"Error loading source code: {str(e)}")
         # Consider logging the error or handling specific exceptions
         raise
                                                                                                                                                                        
- # Example usage                                                                                                                                                       
-directory_path = "/path/to/your/codebase"                                                                                                                             
-load_source_code_to_graph(directory_path) 
+# Default codebase to ingest when none is given on the command line
+directory_path = "/path/to/your/codebase"
 
 # %%
 def setup_qa_chain():
     try:
-        # Ensure we have a valid graph schema
-        graph.refresh_schema()
-        if not graph.schema:
+        # Ensure we have a valid graph schema, refreshing only if
+        # ingestion didn't already capture one
+        global _schema_cache
+        if _schema_cache is None:
+            graph.refresh_schema()
+            _schema_cache = graph.schema
+        if not _schema_cache:
             raise ValueError("Graph schema is empty. Make sure data has been loaded into the graph.")
 
-        # Initialize the language model
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)  # Changed from gpt-4o-mini to gpt-3.5-turbo
-
         # Create a custom prompt template
         CYPHER_GENERATION_TEMPLATE = """
         You are an AI assistant that helps to convert natural language questions about a codebase into Cypher queries.
         Use the following neo4j graph schema to generate Cypher queries:
         {schema}
 
-        The graph contains CodeChunk nodes with properties: content, language, and name.
-        CodeChunks with the same language are connected by SAME_LANGUAGE relationships.
+        The graph contains CodeChunk nodes with properties: content, language, count,
+        and names (the list of source file names the chunk appears in).
+        To find chunks written in a given language, filter on the language property,
+        e.g. WHERE c.language = 'python'. The language property is indexed.
 
         When searching for specific terms, use CONTAINS or =~ for partial matches.
-        Always return the content of the CodeChunk nodes in your queries.
+        Return only the fields needed to answer the question, e.g.
+        RETURN c.content, c.names - never return whole nodes.
+        Always append LIMIT 5 to the query unless the user explicitly asks for more.
         Do not include the word 'cypher' in your query.
 
         Human: {question}
@@ -148,64 +399,97 @@ def setup_qa_chain():
 # %%
 def answer_query(chain, query):
     try:
-        response = chain.run(query)
-        
+        response = chain.invoke({"query": query})
+
         # print("Full response:", response)  # Add this line for debugging
-        
+
         if isinstance(response, dict) and 'intermediate_steps' in response:
-            cypher_query = response['intermediate_steps'][0]['query']
+            # intermediate_steps is [{"query": cypher}, {"context": rows}]
+            steps = response['intermediate_steps']
+            cypher_query = steps[0].get('query', '')
             print("Generated Cypher query:")
             print(cypher_query)
-            
-            cypher_result = response['intermediate_steps'][0]['result']
+
+            cypher_result = steps[1].get('context', []) if len(steps) > 1 else []
             print("Cypher query result:")
             print(cypher_result)
-            
+
             if not cypher_result:
                 return "No matching data found in the graph for this query."
-            
-            # Process the cypher_result to generate a meaningful answer
-            if isinstance(cypher_result, list) and len(cypher_result) > 0:
-                content = cypher_result[0].get('c.content', '')
-                if content:
-                    return f"Found relevant content: {content[:1000]}..."
-                else:
-                    return "No relevant content found in the matched nodes."
-            else:
-                return f"Unexpected result format: {cypher_result}"
-        
-        # If the response is a string, return it directly
-        if isinstance(response, str):
-            return response
-        
+
+            # The QA LLM already summarized the rows into the answer
+            return response['result']
+
         # If we reach here, we couldn't find a proper answer
         return f"Unable to generate an answer. Response structure: {type(response)}"
     except Exception as e:
         print(f"Error in answer_query: {str(e)}")
         return f"An error occurred while processing your query: {str(e)}"
 
+# %%
+async def run_query_batch(chain, queries, concurrency):
+    """Run queries through the chain concurrently, printing per-query latency."""
+    sem = asyncio.Semaphore(concurrency)
+
+    async def run_one(index, query):
+        async with sem:
+            start = time.perf_counter()
+            answer = await asyncio.to_thread(answer_query, chain, query)
+            elapsed = time.perf_counter() - start
+            print(f"[query {index}] {elapsed:.2f}s: {query}")
+            print("Answer:", answer)
+            print()
+
+    await asyncio.gather(
+        *(run_one(index, query) for index, query in enumerate(queries, 1))
+    )
+
 # %%
 def main():
+    parser = argparse.ArgumentParser(
+        description="Load a codebase into Neo4j and answer questions about it."
+    )
+    parser.add_argument(
+        "directory", nargs="?", default=directory_path,
+        help="Path to the codebase to ingest"
+    )
+    parser.add_argument(
+        "--queries-file",
+        help="Read newline-separated queries from this file and run them "
+             "concurrently instead of starting the interactive prompt"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=4,
+        help="How many queries from --queries-file to run at once"
+    )
+    args = parser.parse_args()
+
     try:
-        print(f"Loading source code from: {directory_path}")
-        load_source_code_to_graph(directory_path)
-        
+        print(f"Loading source code from: {args.directory}")
+        asyncio.run(load_source_code_to_graph(args.directory))
+
         # Print some statistics about the loaded data
         node_count = graph.query("MATCH (n:CodeChunk) RETURN count(n) as count")[0]['count']
         print(f"Loaded {node_count} code chunks into the graph.")
 
         qa_chain = setup_qa_chain()
 
-        while True:
-            user_query = input("Ask a question about the code (or type 'exit' to quit): ")
-            if user_query.lower() == 'exit':
-                break
-            try:
-                answer = answer_query(qa_chain, user_query)
-                print("Answer:", answer)
-            except Exception as e:
-                print(f"An error occurred while processing the query: {str(e)}")
-            print()
+        if args.queries_file:
+            with open(args.queries_file) as f:
+                queries = [line.strip() for line in f if line.strip()]
+            print(f"Running {len(queries)} queries from {args.queries_file}")
+            asyncio.run(run_query_batch(qa_chain, queries, args.concurrency))
+        else:
+            while True:
+                user_query = input("Ask a question about the code (or type 'exit' to quit): ")
+                if user_query.lower() == 'exit':
+                    break
+                try:
+                    answer = answer_query(qa_chain, user_query)
+                    print("Answer:", answer)
+                except Exception as e:
+                    print(f"An error occurred while processing the query: {str(e)}")
+                print()
     except Exception as e:
         print(f"An error occurred: {str(e)}")
     print("Exiting the program.")